@@ -5,12 +5,19 @@ Permet de creer des corpus, indexer des documents et effectuer des requetes RAG
 """
 
 import asyncio
-import json
+import contextlib
+import logging
 import os
+import tempfile
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Awaitable, Callable, Optional
 
+import orjson
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
 from mcp.types import Tool, TextContent
@@ -18,10 +25,13 @@ from mcp.types import Tool, TextContent
 # Configuration Google Cloud
 PROJECT_ID = os.getenv("GOOGLE_PROJECT_ID")
 LOCATION = os.getenv("GOOGLE_LOCATION", "us-central1")
+# Bucket GCS de transit pour rag_import_documents (sinon repertoire local)
+STAGING_BUCKET = os.getenv("GOOGLE_RAG_STAGING_BUCKET")
 
 # Import conditionnel de Vertex AI
 try:
     from google.cloud import aiplatform
+    from google.cloud import storage
     from vertexai.preview import rag
     from vertexai.preview.generative_models import GenerativeModel, Tool as VertexTool
     import vertexai
@@ -29,14 +39,83 @@ try:
 except ImportError:
     VERTEX_AVAILABLE = False
 
+# Les logs partent sur stderr: stdout est reserve au protocole MCP
+log = logging.getLogger("vertex-rag")
+# Ajoute la traceback complete aux reponses d'erreur (a eviter en prod)
+DEBUG_ERRORS = os.getenv("VERTEX_RAG_DEBUG", "").lower() in ("1", "true", "yes")
+# Les arguments (documents, prompts) ne sont jamais logges en entier
+LOG_ARG_MAX_CHARS = 200
+
 server = Server("vertex-rag")
 
+# Limites de concurrence vers Vertex AI (protection du quota)
+# Les imports, longs, ont leur propre semaphore pour ne pas bloquer les requetes
+_vertex_sem = asyncio.Semaphore(int(os.getenv("VERTEX_MAX_CONCURRENCY", "8")))
+_import_sem = asyncio.Semaphore(int(os.getenv("VERTEX_MAX_IMPORT_CONCURRENCY", "16")))
+IMPORT_TOOLS = {"rag_import_documents", "rag_import_from_gcs"}
+# Outils qui prennent eux-memes un jeton par appel Vertex (pas de jeton global,
+# qui bloquerait les jetons demandes ensuite par le meme appel)
+SELF_LIMITED_TOOLS = {"rag_query_batch"}
+MAX_BATCH_QUERIES = 32
+
+# Pool dedie aux ecritures/envois de documents, pour ne pas saturer
+# l'executeur par defaut utilise par les autres appels SDK
+STAGING_MAX_WORKERS = 8
+_staging_executor = ThreadPoolExecutor(max_workers=STAGING_MAX_WORKERS, thread_name_prefix="rag-staging")
+
 # Cache des corpus pour eviter les appels API repetitifs
-corpus_cache = {}
+# display_name -> (corpus, timestamp); corpus a None = supprime
+corpus_cache: dict[str, tuple[Any, float]] = {}
+CORPUS_CACHE_TTL = 60  # secondes
+# Date du dernier rechargement complet: un nom absent du cache n'existe pas
+_corpus_cache_refreshed_at: Optional[float] = None
+
+# Cache des resultats des outils en lecture seule, borne en taille
+# (nom de l'outil, arguments...) -> (resultat, timestamp)
+result_cache: dict[tuple, tuple[Any, float]] = {}
+RESULT_CACHE_TTL = 30  # secondes
+RESULT_CACHE_MAXSIZE = 128
+# Chargements en cours, partages par les appels concurrents sur une meme cle
+_result_inflight: dict[tuple, asyncio.Future] = {}
+# Incremente a chaque invalidation: un chargement demarre avant ne doit pas
+# reecrire un resultat perime dans le cache
+_result_generation = 0
+
+# Modeles Gemini avec outil RAG, reutilises entre les appels
+# (model_name, corpus_name, top_k) -> GenerativeModel
+model_cache: dict[tuple[str, str, int], Any] = {}
+MODEL_CACHE_MAXSIZE = 32
+
+# Vertex AI n'est initialise qu'une fois par processus
+_initialized = False
+_storage_client = None
+
+
+def dumps(obj: Any, indent: bool = False) -> str:
+    """Serialise en JSON (orjson); les types inconnus sont convertis en str"""
+    option = orjson.OPT_NON_STR_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, option=option, default=str).decode()
+
+
+def _isoformat(value: Any) -> str:
+    """Formate un horodatage (datetime, sous-classe ou Timestamp protobuf) en ISO 8601"""
+    if value is None or value == '':
+        return ''
+    if hasattr(value, 'ToDatetime'):
+        value = value.ToDatetime()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
 
 
 def init_vertex():
-    """Initialise Vertex AI avec le projet et la region"""
+    """Initialise Vertex AI avec le projet et la region (idempotent)"""
+    global _initialized
+    if _initialized:
+        return
+
     if not VERTEX_AVAILABLE:
         raise RuntimeError("google-cloud-aiplatform non installe. Executer: pip install google-cloud-aiplatform")
 
@@ -44,534 +123,824 @@ def init_vertex():
         raise RuntimeError("GOOGLE_PROJECT_ID non defini dans .env")
 
     vertexai.init(project=PROJECT_ID, location=LOCATION)
+    _initialized = True
+
+
+async def _load_corpora() -> list[Any]:
+    """Liste les corpus via l'API et alimente corpus_cache au passage"""
+    global _corpus_cache_refreshed_at
+    # Horodatage pris avant l'appel: les creations/suppressions faites pendant
+    # la liste sont plus recentes que celle-ci et ne doivent pas etre ecrasees
+    started = time.monotonic()
+    corpora = await asyncio.to_thread(lambda: list(rag.list_corpora()))
+
+    listed = {corpus.display_name: corpus for corpus in corpora}
+    for display_name, (_, timestamp) in list(corpus_cache.items()):
+        if timestamp < started and display_name not in listed:
+            del corpus_cache[display_name]
+    for display_name, corpus in listed.items():
+        entry = corpus_cache.get(display_name)
+        if entry is None or entry[1] < started:
+            corpus_cache[display_name] = (corpus, started)
+    _corpus_cache_refreshed_at = started
+    return corpora
+
+
+async def list_corpora_cached() -> list[Any]:
+    """Liste des corpus partagee par rag_list_corpora et les recherches par nom"""
+    return await get_cached(("rag_list_corpora",), _load_corpora)
 
 
-def get_corpus_by_name(display_name: str) -> Optional[Any]:
-    """Recupere un corpus par son nom d'affichage"""
+async def _refresh_and_lookup(display_name: str) -> Optional[Any]:
+    """Recharge le cache des corpus depuis l'API puis cherche le nom d'affichage"""
     try:
-        corpora = rag.list_corpora()
-        for corpus in corpora:
-            if corpus.display_name == display_name:
-                return corpus
-        return None
+        await list_corpora_cached()
     except Exception as e:
         return None
 
+    entry = corpus_cache.get(display_name)
+    return entry[0] if entry else None
 
-@server.list_tools()
-async def list_tools() -> list[Tool]:
-    """Liste les outils disponibles"""
-    return [
-        Tool(
-            name="rag_create_corpus",
-            description="Cree un nouveau corpus RAG pour stocker des documents. Un corpus = un projet/domaine.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "display_name": {
-                        "type": "string",
-                        "description": "Nom du corpus (ex: 'artisaas-interventions', 'bizdev-calls')"
-                    },
-                    "description": {
-                        "type": "string",
-                        "description": "Description du corpus"
-                    }
+
+async def get_corpus_by_name(display_name: str) -> Optional[Any]:
+    """Recupere un corpus par son nom d'affichage (via le cache si possible)"""
+    now = time.monotonic()
+    entry = corpus_cache.get(display_name)
+    if entry and now - entry[1] < CORPUS_CACHE_TTL:
+        return entry[0]
+
+    # Cache complet et encore frais: le corpus n'existe pas, inutile de lister
+    if not entry and _corpus_cache_refreshed_at is not None and now - _corpus_cache_refreshed_at < CORPUS_CACHE_TTL:
+        return None
+
+    return await _refresh_and_lookup(display_name)
+
+
+def invalidate_corpus(corpus_name: str):
+    """Retire des caches le corpus correspondant a un nom complet"""
+    # Marque supprime plutot que retirer, pour qu'une liste en cours ne le ressuscite pas
+    for display_name, (corpus, _) in list(corpus_cache.items()):
+        if corpus is not None and corpus.name == corpus_name:
+            corpus_cache[display_name] = (None, time.monotonic())
+
+    for key in list(model_cache):
+        if key[1] == corpus_name:
+            del model_cache[key]
+
+
+def get_storage_client():
+    """Retourne le client GCS partage (cree au premier appel)"""
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client(project=PROJECT_ID)
+    return _storage_client
+
+
+def _doc_content(doc: dict[str, Any]) -> str:
+    """Construit le contenu texte d'un document"""
+    content = doc['content']
+
+    # Ajouter les metadonnees en header si presentes
+    if doc.get('metadata'):
+        metadata_str = dumps(doc['metadata'])
+        content = f"[METADATA: {metadata_str}]\n\n{content}"
+
+    return content
+
+
+async def get_cached(key: tuple, loader: Callable[[], Awaitable[Any]], ttl: float = RESULT_CACHE_TTL) -> Any:
+    """Retourne le resultat en cache ou le charge; les appels concurrents partagent un seul chargement"""
+    entry = result_cache.get(key)
+    if entry and time.monotonic() - entry[1] < ttl:
+        return entry[0]
+
+    future = _result_inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_load_result(key, loader))
+        _result_inflight[key] = future
+        future.add_done_callback(
+            lambda done: _result_inflight.pop(key) if _result_inflight.get(key) is done else None
+        )
+    return await asyncio.shield(future)
+
+
+async def _load_result(key: tuple, loader: Callable[[], Awaitable[Any]]) -> Any:
+    """Charge un resultat et l'enregistre, en evincant les plus anciens au-dela de la taille max"""
+    generation = _result_generation
+    value = await loader()
+    if generation != _result_generation:
+        # Invalide pendant le chargement: resultat rendu a l'appelant mais pas mis en cache
+        return value
+    result_cache.pop(key, None)
+    result_cache[key] = (value, time.monotonic())
+    while len(result_cache) > RESULT_CACHE_MAXSIZE:
+        del result_cache[next(iter(result_cache))]
+    return value
+
+
+def invalidate_results(*keys: tuple):
+    """Retire des resultats du cache apres une ecriture"""
+    global _result_generation
+    _result_generation += 1
+    for key in keys:
+        result_cache.pop(key, None)
+        # Les appels suivants relancent un chargement posterieur a l'ecriture
+        _result_inflight.pop(key, None)
+
+
+def get_rag_model(model_name: str, corpus_name: str, top_k: int) -> Any:
+    """Retourne le modele configure avec le retrieval RAG (cree au premier appel)"""
+    key = (model_name, corpus_name, top_k)
+    model = model_cache.get(key)
+    if model is None:
+        # Configurer le RAG retrieval
+        rag_retrieval_tool = VertexTool.from_retrieval(
+            retrieval=rag.Retrieval(
+                source=rag.VertexRagStore(
+                    rag_resources=[
+                        rag.RagResource(rag_corpus=corpus_name)
+                    ],
+                    similarity_top_k=top_k
+                )
+            )
+        )
+
+        # Creer le modele avec RAG
+        model = GenerativeModel(
+            model_name=model_name,
+            tools=[rag_retrieval_tool]
+        )
+        model_cache[key] = model
+        while len(model_cache) > MODEL_CACHE_MAXSIZE:
+            del model_cache[next(iter(model_cache))]
+    return model
+
+
+def _write_doc(temp_dir: Path, doc: dict[str, Any]):
+    """Ecrit un document dans le repertoire temporaire"""
+    doc_path = temp_dir / f"{doc['id']}.txt"
+    doc_path.write_text(_doc_content(doc), encoding='utf-8')
+
+
+def _upload_doc(bucket: Any, prefix: str, doc: dict[str, Any]):
+    """Envoie un document directement dans le bucket GCS de transit"""
+    blob = bucket.blob(f"{prefix}/{doc['id']}.txt")
+    blob.upload_from_string(_doc_content(doc), content_type="text/plain; charset=utf-8")
+
+
+async def _stage_docs(calls: list[tuple]):
+    """Execute les ecritures/envois de documents sur le pool dedie"""
+    # Tout attendre avant de remonter une erreur: le nettoyage ne doit pas
+    # passer avant un envoi encore en cours
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*[
+        loop.run_in_executor(_staging_executor, fn, *args) for fn, *args in calls
+    ], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+async def _delete_prefix(bucket: Any, prefix: str):
+    """Supprime les documents de transit une fois l'import termine"""
+    # Un echec de nettoyage ne doit pas masquer le resultat de l'import
+    try:
+        blobs = await asyncio.to_thread(lambda: list(bucket.list_blobs(prefix=f"{prefix}/")))
+        await _stage_docs([(blob.delete,) for blob in blobs])
+    except Exception as e:
+        log.warning("cleanup gs://%s/%s/ failed: %s", bucket.name, prefix, e)
+
+
+def _iter_stats(corpus_name: str) -> tuple[int, int]:
+    """Compte les fichiers et leur taille totale sans materialiser la liste"""
+    count, total = 0, 0
+    for f in rag.list_files(corpus_name=corpus_name):
+        count += 1
+        total += getattr(f, 'size_bytes', 0)
+    return count, total
+
+
+def _truncate(value: str) -> str:
+    """Tronque une chaine longue pour les logs"""
+    if len(value) <= LOG_ARG_MAX_CHARS:
+        return value
+    return f"{value[:LOG_ARG_MAX_CHARS]}... ({len(value)} caracteres)"
+
+
+def _loggable_arguments(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Copie des arguments pour les logs: listes resumees, textes longs tronques"""
+    loggable = {}
+    for key, value in arguments.items():
+        if isinstance(value, list):
+            loggable[key] = f"<{len(value)} {key}>"
+        elif isinstance(value, str):
+            loggable[key] = _truncate(value)
+        elif isinstance(value, dict):
+            loggable[key] = f"<{len(value)} cles>"
+        else:
+            loggable[key] = value
+    return loggable
+
+
+# Definitions des outils, construites une seule fois a l'import
+TOOLS: list[Tool] = [
+    Tool(
+        name="rag_create_corpus",
+        description="Cree un nouveau corpus RAG pour stocker des documents. Un corpus = un projet/domaine.",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "display_name": {
+                    "type": "string",
+                    "description": "Nom du corpus (ex: 'artisaas-interventions', 'bizdev-calls')"
                 },
-                "required": ["display_name"]
-            }
-        ),
-        Tool(
-            name="rag_list_corpora",
-            description="Liste tous les corpus RAG existants",
-            inputSchema={
-                "type": "object",
-                "properties": {},
-                "required": []
-            }
-        ),
-        Tool(
-            name="rag_delete_corpus",
-            description="Supprime un corpus RAG",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "corpus_name": {
-                        "type": "string",
-                        "description": "Nom complet du corpus (format: projects/.../locations/.../ragCorpora/...)"
-                    }
+                "description": {
+                    "type": "string",
+                    "description": "Description du corpus"
+                }
+            },
+            "required": ["display_name"]
+        }
+    ),
+    Tool(
+        name="rag_list_corpora",
+        description="Liste tous les corpus RAG existants",
+        inputSchema={
+            "type": "object",
+            "properties": {},
+            "required": []
+        }
+    ),
+    Tool(
+        name="rag_delete_corpus",
+        description="Supprime un corpus RAG",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "corpus_name": {
+                    "type": "string",
+                    "description": "Nom complet du corpus (format: projects/.../locations/.../ragCorpora/...)"
+                }
+            },
+            "required": ["corpus_name"]
+        }
+    ),
+    Tool(
+        name="rag_import_documents",
+        description="Importe des documents texte dans un corpus. Supporte JSON, texte brut, ou liste de documents.",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "corpus_name": {
+                    "type": "string",
+                    "description": "Nom du corpus cible"
                 },
-                "required": ["corpus_name"]
-            }
-        ),
-        Tool(
-            name="rag_import_documents",
-            description="Importe des documents texte dans un corpus. Supporte JSON, texte brut, ou liste de documents.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "corpus_name": {
-                        "type": "string",
-                        "description": "Nom du corpus cible"
-                    },
-                    "documents": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "id": {"type": "string", "description": "ID unique du document"},
-                                "content": {"type": "string", "description": "Contenu texte du document"},
-                                "metadata": {"type": "object", "description": "Metadonnees optionnelles"}
-                            },
-                            "required": ["id", "content"]
+                "documents": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "string", "description": "ID unique du document"},
+                            "content": {"type": "string", "description": "Contenu texte du document"},
+                            "metadata": {"type": "object", "description": "Metadonnees optionnelles"}
                         },
-                        "description": "Liste des documents a importer"
-                    },
-                    "chunk_size": {
-                        "type": "integer",
-                        "description": "Taille des chunks en tokens (defaut: 512)",
-                        "default": 512
+                        "required": ["id", "content"]
                     },
-                    "chunk_overlap": {
-                        "type": "integer",
-                        "description": "Chevauchement entre chunks (defaut: 100)",
-                        "default": 100
-                    }
+                    "description": "Liste des documents a importer"
                 },
-                "required": ["corpus_name", "documents"]
-            }
-        ),
-        Tool(
-            name="rag_import_from_gcs",
-            description="Importe des documents depuis Google Cloud Storage",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "corpus_name": {
-                        "type": "string",
-                        "description": "Nom du corpus cible"
-                    },
-                    "gcs_uri": {
-                        "type": "string",
-                        "description": "URI GCS (ex: gs://bucket/folder/)"
-                    }
+                "chunk_size": {
+                    "type": "integer",
+                    "description": "Taille des chunks en tokens (defaut: 512)",
+                    "default": 512
                 },
-                "required": ["corpus_name", "gcs_uri"]
-            }
-        ),
-        Tool(
-            name="rag_query",
-            description="Effectue une recherche semantique dans un corpus",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "corpus_name": {
-                        "type": "string",
-                        "description": "Nom du corpus a interroger"
-                    },
-                    "query": {
-                        "type": "string",
-                        "description": "Question ou requete de recherche"
-                    },
-                    "top_k": {
-                        "type": "integer",
-                        "description": "Nombre de resultats a retourner (defaut: 5)",
-                        "default": 5
-                    },
-                    "similarity_threshold": {
-                        "type": "number",
-                        "description": "Seuil de similarite minimum (0-1, defaut: 0.7)",
-                        "default": 0.7
-                    }
+                "chunk_overlap": {
+                    "type": "integer",
+                    "description": "Chevauchement entre chunks (defaut: 100)",
+                    "default": 100
+                }
+            },
+            "required": ["corpus_name", "documents"]
+        }
+    ),
+    Tool(
+        name="rag_import_from_gcs",
+        description="Importe des documents depuis Google Cloud Storage",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "corpus_name": {
+                    "type": "string",
+                    "description": "Nom du corpus cible"
                 },
-                "required": ["corpus_name", "query"]
-            }
-        ),
-        Tool(
-            name="rag_generate",
-            description="Genere une reponse basee sur le contexte RAG (retrieval + generation)",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "corpus_name": {
-                        "type": "string",
-                        "description": "Nom du corpus a utiliser"
-                    },
-                    "prompt": {
-                        "type": "string",
-                        "description": "Question ou instruction pour la generation"
-                    },
-                    "model": {
-                        "type": "string",
-                        "description": "Modele Gemini a utiliser (defaut: gemini-1.5-flash)",
-                        "default": "gemini-1.5-flash"
-                    },
-                    "top_k": {
-                        "type": "integer",
-                        "description": "Nombre de documents contextuels (defaut: 5)",
-                        "default": 5
-                    },
-                    "temperature": {
-                        "type": "number",
-                        "description": "Temperature de generation (0-1, defaut: 0.2)",
-                        "default": 0.2
-                    }
+                "gcs_uri": {
+                    "type": "string",
+                    "description": "URI GCS (ex: gs://bucket/folder/)"
+                }
+            },
+            "required": ["corpus_name", "gcs_uri"]
+        }
+    ),
+    Tool(
+        name="rag_query",
+        description="Effectue une recherche semantique dans un corpus",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "corpus_name": {
+                    "type": "string",
+                    "description": "Nom du corpus a interroger"
                 },
-                "required": ["corpus_name", "prompt"]
-            }
-        ),
-        Tool(
-            name="rag_list_files",
-            description="Liste les fichiers indexes dans un corpus",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "corpus_name": {
-                        "type": "string",
-                        "description": "Nom du corpus"
-                    }
+                "query": {
+                    "type": "string",
+                    "description": "Question ou requete de recherche"
                 },
-                "required": ["corpus_name"]
-            }
-        ),
-        Tool(
-            name="rag_get_corpus_stats",
-            description="Recupere les statistiques d'un corpus (nombre de documents, taille, etc.)",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "corpus_name": {
-                        "type": "string",
-                        "description": "Nom du corpus"
-                    }
+                "top_k": {
+                    "type": "integer",
+                    "description": "Nombre de resultats a retourner (defaut: 5)",
+                    "default": 5
                 },
-                "required": ["corpus_name"]
-            }
-        )
-    ]
-
+                "vector_distance_threshold": {
+                    "type": "number",
+                    "description": "Distance vectorielle maximum (0-1, plus bas = plus strict, defaut: 0.3)",
+                    "default": 0.3
+                }
+            },
+            "required": ["corpus_name", "query"]
+        }
+    ),
+    Tool(
+        name="rag_query_batch",
+        description="Effectue plusieurs recherches semantiques en parallele dans un meme corpus",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "corpus_name": {
+                    "type": "string",
+                    "description": "Nom du corpus a interroger"
+                },
+                "queries": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "maxItems": MAX_BATCH_QUERIES,
+                    "description": f"Liste de questions ou requetes de recherche (max: {MAX_BATCH_QUERIES})"
+                },
+                "top_k": {
+                    "type": "integer",
+                    "description": "Nombre de resultats a retourner par requete (defaut: 5)",
+                    "default": 5
+                },
+                "vector_distance_threshold": {
+                    "type": "number",
+                    "description": "Distance vectorielle maximum (0-1, plus bas = plus strict, defaut: 0.3)",
+                    "default": 0.3
+                }
+            },
+            "required": ["corpus_name", "queries"]
+        }
+    ),
+    Tool(
+        name="rag_generate",
+        description="Genere une reponse basee sur le contexte RAG (retrieval + generation)",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "corpus_name": {
+                    "type": "string",
+                    "description": "Nom du corpus a utiliser"
+                },
+                "prompt": {
+                    "type": "string",
+                    "description": "Question ou instruction pour la generation"
+                },
+                "model": {
+                    "type": "string",
+                    "description": "Modele Gemini a utiliser (defaut: gemini-1.5-flash)",
+                    "default": "gemini-1.5-flash"
+                },
+                "top_k": {
+                    "type": "integer",
+                    "description": "Nombre de documents contextuels (defaut: 5)",
+                    "default": 5
+                },
+                "temperature": {
+                    "type": "number",
+                    "description": "Temperature de generation (0-1, defaut: 0.2)",
+                    "default": 0.2
+                }
+            },
+            "required": ["corpus_name", "prompt"]
+        }
+    ),
+    Tool(
+        name="rag_list_files",
+        description="Liste les fichiers indexes dans un corpus",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "corpus_name": {
+                    "type": "string",
+                    "description": "Nom du corpus"
+                }
+            },
+            "required": ["corpus_name"]
+        }
+    ),
+    Tool(
+        name="rag_get_corpus_stats",
+        description="Recupere les statistiques d'un corpus (nombre de documents, taille, etc.)",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "corpus_name": {
+                    "type": "string",
+                    "description": "Nom du corpus"
+                }
+            },
+            "required": ["corpus_name"]
+        }
+    )
+]
 
-@server.call_tool()
-async def call_tool(name: str, arguments: dict[str, Any]) -> list[TextContent]:
-    """Execute un outil RAG"""
 
-    try:
-        init_vertex()
-    except Exception as e:
-        return [TextContent(
-            type="text",
-            text=json.dumps({"error": str(e)}, ensure_ascii=False)
-        )]
+@server.list_tools()
+async def list_tools() -> list[Tool]:
+    """Liste les outils disponibles"""
+    return TOOLS
+
+
+async def _handle_create_corpus(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Cree un corpus s'il n'existe pas deja"""
+    display_name = arguments["display_name"]
+    description = arguments.get("description", f"Corpus cree le {datetime.now().isoformat()}")
+
+    # Verifier si le corpus existe deja
+    existing = await get_corpus_by_name(display_name)
+    if existing:
+        return {
+            "status": "exists",
+            "message": f"Corpus '{display_name}' existe deja",
+            "corpus_name": existing.name
+        }
+
+    # Creer le corpus
+    corpus = await asyncio.to_thread(
+        rag.create_corpus,
+        display_name=display_name,
+        description=description
+    )
+    corpus_cache[corpus.display_name] = (corpus, time.monotonic())
+    invalidate_results(("rag_list_corpora",))
+
+    return {
+        "status": "success",
+        "message": f"Corpus '{display_name}' cree",
+        "corpus_name": corpus.name,
+        "display_name": corpus.display_name
+    }
+
+
+async def _handle_list_corpora(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Liste les corpus existants"""
+    corpora = await list_corpora_cached()
+    corpus_list = [
+        {
+            "name": c.name,
+            "display_name": c.display_name,
+            "description": getattr(c, 'description', ''),
+            "create_time": _isoformat(getattr(c, 'create_time', None))
+        }
+        for c in corpora
+    ]
 
-    if name == "rag_create_corpus":
-        display_name = arguments["display_name"]
-        description = arguments.get("description", f"Corpus cree le {datetime.now().isoformat()}")
+    return {
+        "status": "success",
+        "count": len(corpus_list),
+        "corpora": corpus_list
+    }
 
-        try:
-            # Verifier si le corpus existe deja
-            existing = get_corpus_by_name(display_name)
-            if existing:
-                return [TextContent(
-                    type="text",
-                    text=json.dumps({
-                        "status": "exists",
-                        "message": f"Corpus '{display_name}' existe deja",
-                        "corpus_name": existing.name
-                    }, ensure_ascii=False)
-                )]
-
-            # Creer le corpus
-            corpus = rag.create_corpus(
-                display_name=display_name,
-                description=description
-            )
 
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "message": f"Corpus '{display_name}' cree",
-                    "corpus_name": corpus.name,
-                    "display_name": corpus.display_name
-                }, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    elif name == "rag_list_corpora":
-        try:
-            corpora = rag.list_corpora()
-            corpus_list = []
-            for c in corpora:
-                corpus_list.append({
-                    "name": c.name,
-                    "display_name": c.display_name,
-                    "description": getattr(c, 'description', ''),
-                    "create_time": str(getattr(c, 'create_time', ''))
-                })
-
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "count": len(corpus_list),
-                    "corpora": corpus_list
-                }, indent=2, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    elif name == "rag_delete_corpus":
-        corpus_name = arguments["corpus_name"]
+async def _handle_delete_corpus(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Supprime un corpus"""
+    corpus_name = arguments["corpus_name"]
 
-        try:
-            rag.delete_corpus(name=corpus_name)
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "message": f"Corpus supprime: {corpus_name}"
-                }, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    elif name == "rag_import_documents":
-        corpus_name = arguments["corpus_name"]
-        documents = arguments["documents"]
-        chunk_size = arguments.get("chunk_size", 512)
-        chunk_overlap = arguments.get("chunk_overlap", 100)
+    await asyncio.to_thread(rag.delete_corpus, name=corpus_name)
+    invalidate_corpus(corpus_name)
+    invalidate_results(("rag_list_corpora",), ("rag_get_corpus_stats", corpus_name))
 
-        try:
-            # Creer un fichier temporaire avec les documents
-            import tempfile
-            import shutil
+    return {
+        "status": "success",
+        "message": f"Corpus supprime: {corpus_name}"
+    }
 
-            temp_dir = Path(tempfile.mkdtemp())
-            imported_count = 0
 
-            for doc in documents:
-                doc_path = temp_dir / f"{doc['id']}.txt"
-                content = doc['content']
+async def _handle_import_documents(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Importe des documents texte dans un corpus"""
+    corpus_name = arguments["corpus_name"]
+    # Un seul fichier par id, comme l'ancien repertoire unique: le dernier l'emporte
+    documents = list({doc['id']: doc for doc in arguments["documents"]}.values())
+    chunk_size = arguments.get("chunk_size", 512)
+    chunk_overlap = arguments.get("chunk_overlap", 100)
 
-                # Ajouter les metadonnees en header si presentes
-                if 'metadata' in doc and doc['metadata']:
-                    metadata_str = json.dumps(doc['metadata'], ensure_ascii=False)
-                    content = f"[METADATA: {metadata_str}]\n\n{content}"
+    if STAGING_BUCKET:
+        # Envoyer les documents directement sur GCS, sans passer par le disque
+        bucket = get_storage_client().bucket(STAGING_BUCKET)
+        prefix = f"rag-staging/{uuid.uuid4().hex}"
 
-                doc_path.write_text(content, encoding='utf-8')
-                imported_count += 1
+        try:
+            await _stage_docs([(_upload_doc, bucket, prefix, doc) for doc in documents])
 
             # Importer dans le corpus
-            rag.import_files(
+            response = await asyncio.to_thread(
+                rag.import_files,
                 corpus_name=corpus_name,
-                paths=[str(temp_dir)],
+                paths=[f"gs://{STAGING_BUCKET}/{prefix}/"],
                 chunk_size=chunk_size,
                 chunk_overlap=chunk_overlap
             )
+        finally:
+            invalidate_results(("rag_get_corpus_stats", corpus_name))
+            await _delete_prefix(bucket, prefix)
+    else:
+        # Repertoire temporaire avec les documents, supprime meme en cas d'erreur
+        with tempfile.TemporaryDirectory() as temp_dir_str:
+            temp_dir = Path(temp_dir_str)
 
-            # Nettoyer
-            shutil.rmtree(temp_dir)
-
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "message": f"{imported_count} documents importes dans {corpus_name}",
-                    "chunk_size": chunk_size,
-                    "chunk_overlap": chunk_overlap
-                }, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    elif name == "rag_import_from_gcs":
-        corpus_name = arguments["corpus_name"]
-        gcs_uri = arguments["gcs_uri"]
+            # Ecrire les documents en parallele, hors de la boucle d'evenements
+            await _stage_docs([(_write_doc, temp_dir, doc) for doc in documents])
 
-        try:
-            rag.import_files(
-                corpus_name=corpus_name,
-                paths=[gcs_uri]
+            # Importer dans le corpus
+            try:
+                response = await asyncio.to_thread(
+                    rag.import_files,
+                    corpus_name=corpus_name,
+                    paths=[str(temp_dir)],
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap
+                )
+            finally:
+                invalidate_results(("rag_get_corpus_stats", corpus_name))
+
+    return {
+        "status": "success",
+        "message": f"{len(documents)} documents importes dans {corpus_name}",
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "imported_files": getattr(response, 'imported_rag_files_count', None),
+        "skipped_files": getattr(response, 'skipped_rag_files_count', None)
+    }
+
+
+async def _handle_import_from_gcs(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Importe des documents depuis GCS"""
+    corpus_name = arguments["corpus_name"]
+    gcs_uri = arguments["gcs_uri"]
+
+    await asyncio.to_thread(
+        rag.import_files,
+        corpus_name=corpus_name,
+        paths=[gcs_uri]
+    )
+    invalidate_results(("rag_get_corpus_stats", corpus_name))
+
+    return {
+        "status": "success",
+        "message": f"Import depuis {gcs_uri} lance"
+    }
+
+
+def _distance_threshold(arguments: dict[str, Any]) -> float:
+    """Seuil de distance vectorielle, en convertissant l'ancien similarity_threshold"""
+    if "similarity_threshold" in arguments:
+        if "vector_distance_threshold" in arguments:
+            raise ValueError("similarity_threshold et vector_distance_threshold sont exclusifs")
+        # Ancien parametre: similarite (plus haut = plus strict) -> distance
+        return 1 - arguments["similarity_threshold"]
+    return arguments.get("vector_distance_threshold", 0.3)
+
+
+async def _retrieve(corpus_name: str, query: str, top_k: int, vector_distance_threshold: float) -> list[dict[str, Any]]:
+    """Execute une recherche semantique et formate les contextes retournes"""
+    response = await asyncio.to_thread(
+        rag.retrieval_query,
+        rag_resources=[
+            rag.RagResource(
+                rag_corpus=corpus_name
             )
+        ],
+        text=query,
+        similarity_top_k=top_k,
+        vector_distance_threshold=vector_distance_threshold
+    )
 
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "message": f"Import depuis {gcs_uri} lance"
-                }, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    elif name == "rag_query":
-        corpus_name = arguments["corpus_name"]
-        query = arguments["query"]
-        top_k = arguments.get("top_k", 5)
-        similarity_threshold = arguments.get("similarity_threshold", 0.7)
+    return [
+        {
+            "text": context.text,
+            "source": getattr(context, 'source_uri', 'unknown'),
+            "score": getattr(context, 'score', 0)
+        }
+        for context in response.contexts.contexts
+    ]
 
-        try:
-            response = rag.retrieval_query(
-                rag_resources=[
-                    rag.RagResource(
-                        rag_corpus=corpus_name
-                    )
-                ],
-                text=query,
-                similarity_top_k=top_k,
-                vector_distance_threshold=1 - similarity_threshold  # Convertir similarite en distance
-            )
 
-            results = []
-            for context in response.contexts.contexts:
-                results.append({
-                    "text": context.text,
-                    "source": getattr(context, 'source_uri', 'unknown'),
-                    "score": getattr(context, 'score', 0)
-                })
-
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "query": query,
-                    "results_count": len(results),
-                    "results": results
-                }, indent=2, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    elif name == "rag_generate":
-        corpus_name = arguments["corpus_name"]
-        prompt = arguments["prompt"]
-        model_name = arguments.get("model", "gemini-1.5-flash")
-        top_k = arguments.get("top_k", 5)
-        temperature = arguments.get("temperature", 0.2)
+async def _handle_query(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Recherche semantique dans un corpus"""
+    corpus_name = arguments["corpus_name"]
+    query = arguments["query"]
+    top_k = arguments.get("top_k", 5)
+    vector_distance_threshold = _distance_threshold(arguments)
+
+    results = await _retrieve(corpus_name, query, top_k, vector_distance_threshold)
+
+    return {
+        "status": "success",
+        "query": query,
+        "results_count": len(results),
+        "results": results
+    }
+
+
+async def _handle_query_batch(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Plusieurs recherches semantiques lancees en parallele"""
+    corpus_name = arguments["corpus_name"]
+    queries = arguments["queries"]
+    top_k = arguments.get("top_k", 5)
+    vector_distance_threshold = _distance_threshold(arguments)
+
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        raise ValueError("queries doit etre une liste de chaines")
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise ValueError(f"Trop de requetes: {len(queries)} (max: {MAX_BATCH_QUERIES})")
+
+    async def retrieve_limited(query: str) -> list[dict[str, Any]]:
+        async with _vertex_sem:
+            return await _retrieve(corpus_name, query, top_k, vector_distance_threshold)
+
+    responses = await asyncio.gather(*[
+        retrieve_limited(query) for query in queries
+    ], return_exceptions=True)
+
+    batch = []
+    success_count = 0
+    for query, results in zip(queries, responses):
+        if isinstance(results, Exception):
+            log.error("query corpus=%s query=%r failed", corpus_name, _truncate(query), exc_info=results)
+            batch.append({
+                "query": query,
+                "status": "error",
+                "error": type(results).__name__,
+                "message": str(results)
+            })
+        else:
+            success_count += 1
+            batch.append({
+                "query": query,
+                "status": "success",
+                "results_count": len(results),
+                "results": results
+            })
+
+    if success_count == len(queries):
+        status = "success"
+    elif success_count:
+        status = "partial"
+    else:
+        status = "error"
+
+    return {
+        "status": status,
+        "queries_count": len(queries),
+        "queries": batch
+    }
+
+
+async def _handle_generate(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Generation avec contexte RAG"""
+    corpus_name = arguments["corpus_name"]
+    prompt = arguments["prompt"]
+    model_name = arguments.get("model", "gemini-1.5-flash")
+    top_k = arguments.get("top_k", 5)
+    temperature = arguments.get("temperature", 0.2)
+
+    model = get_rag_model(model_name, corpus_name, top_k)
+
+    # Generer la reponse
+    response = await asyncio.to_thread(
+        model.generate_content,
+        prompt,
+        generation_config={
+            "temperature": temperature,
+            "max_output_tokens": 2048
+        }
+    )
+
+    return {
+        "status": "success",
+        "prompt": prompt,
+        "response": response.text,
+        "model": model_name
+    }
+
+
+async def _handle_list_files(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Liste les fichiers indexes d'un corpus"""
+    corpus_name = arguments["corpus_name"]
+
+    files = await asyncio.to_thread(lambda: list(rag.list_files(corpus_name=corpus_name)))
+    file_list = [
+        {
+            "name": f.name,
+            "display_name": getattr(f, 'display_name', ''),
+            "size_bytes": getattr(f, 'size_bytes', 0),
+            "state": str(getattr(f, 'state', 'unknown'))
+        }
+        for f in files
+    ]
 
-        try:
-            # Configurer le RAG retrieval
-            rag_retrieval_tool = VertexTool.from_retrieval(
-                retrieval=rag.Retrieval(
-                    source=rag.VertexRagStore(
-                        rag_resources=[
-                            rag.RagResource(rag_corpus=corpus_name)
-                        ],
-                        similarity_top_k=top_k
-                    )
-                )
-            )
+    return {
+        "status": "success",
+        "corpus": corpus_name,
+        "file_count": len(file_list),
+        "files": file_list
+    }
 
-            # Creer le modele avec RAG
-            model = GenerativeModel(
-                model_name=model_name,
-                tools=[rag_retrieval_tool]
-            )
 
-            # Generer la reponse
-            response = model.generate_content(
-                prompt,
-                generation_config={
-                    "temperature": temperature,
-                    "max_output_tokens": 2048
-                }
-            )
+async def _handle_get_corpus_stats(arguments: dict[str, Any]) -> dict[str, Any]:
+    """Statistiques d'un corpus"""
+    corpus_name = arguments["corpus_name"]
 
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "prompt": prompt,
-                    "response": response.text,
-                    "model": model_name
-                }, indent=2, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    elif name == "rag_list_files":
-        corpus_name = arguments["corpus_name"]
+    # Les deux appels sont independants: on les lance en parallele
+    corpus, (file_count, total_size) = await get_cached(
+        ("rag_get_corpus_stats", corpus_name),
+        lambda: asyncio.gather(
+            asyncio.to_thread(rag.get_corpus, name=corpus_name),
+            asyncio.to_thread(_iter_stats, corpus_name)
+        )
+    )
+
+    return {
+        "status": "success",
+        "corpus_name": corpus_name,
+        "display_name": corpus.display_name,
+        "description": getattr(corpus, 'description', ''),
+        "file_count": file_count,
+        "total_size_bytes": total_size,
+        "total_size_mb": round(total_size / (1024 * 1024), 2),
+        "create_time": _isoformat(getattr(corpus, 'create_time', None))
+    }
+
+
+# Table de dispatch: nom de l'outil -> handler
+HANDLERS: dict[str, Callable[[dict[str, Any]], Awaitable[dict[str, Any]]]] = {
+    "rag_create_corpus": _handle_create_corpus,
+    "rag_list_corpora": _handle_list_corpora,
+    "rag_delete_corpus": _handle_delete_corpus,
+    "rag_import_documents": _handle_import_documents,
+    "rag_import_from_gcs": _handle_import_from_gcs,
+    "rag_query": _handle_query,
+    "rag_query_batch": _handle_query_batch,
+    "rag_generate": _handle_generate,
+    "rag_list_files": _handle_list_files,
+    "rag_get_corpus_stats": _handle_get_corpus_stats,
+}
 
-        try:
-            files = rag.list_files(corpus_name=corpus_name)
-            file_list = []
-            for f in files:
-                file_list.append({
-                    "name": f.name,
-                    "display_name": getattr(f, 'display_name', ''),
-                    "size_bytes": getattr(f, 'size_bytes', 0),
-                    "state": str(getattr(f, 'state', 'unknown'))
-                })
-
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "corpus": corpus_name,
-                    "file_count": len(file_list),
-                    "files": file_list
-                }, indent=2, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    elif name == "rag_get_corpus_stats":
-        corpus_name = arguments["corpus_name"]
 
-        try:
-            corpus = rag.get_corpus(name=corpus_name)
-            files = list(rag.list_files(corpus_name=corpus_name))
-
-            total_size = sum(getattr(f, 'size_bytes', 0) for f in files)
-
-            return [TextContent(
-                type="text",
-                text=json.dumps({
-                    "status": "success",
-                    "corpus_name": corpus_name,
-                    "display_name": corpus.display_name,
-                    "description": getattr(corpus, 'description', ''),
-                    "file_count": len(files),
-                    "total_size_bytes": total_size,
-                    "total_size_mb": round(total_size / (1024 * 1024), 2),
-                    "create_time": str(getattr(corpus, 'create_time', ''))
-                }, indent=2, ensure_ascii=False)
-            )]
-        except Exception as e:
-            return [TextContent(
-                type="text",
-                text=json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False)
-            )]
-
-    return [TextContent(type="text", text=f"Outil inconnu: {name}")]
+@server.call_tool()
+async def call_tool(name: str, arguments: dict[str, Any]) -> list[TextContent]:
+    """Execute un outil RAG"""
+    handler = HANDLERS.get(name)
+    if handler is None:
+        return [TextContent(type="text", text=f"Outil inconnu: {name}")]
+
+    if name in SELF_LIMITED_TOOLS:
+        sem = contextlib.nullcontext()
+    elif name in IMPORT_TOOLS:
+        sem = _import_sem
+    else:
+        sem = _vertex_sem
+    try:
+        async with sem:
+            payload = await handler(arguments)
+    except Exception as e:
+        log.exception("tool=%s args=%s", name, _loggable_arguments(arguments))
+        payload = {
+            "status": "error",
+            "error": type(e).__name__,
+            "message": str(e),
+            "tool": name
+        }
+        if DEBUG_ERRORS:
+            payload["traceback"] = traceback.format_exc()
+
+    return [TextContent(type="text", text=dumps(payload, indent=True))]
 
 
 async def main():
     """Point d'entree principal"""
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+
+    # Echoue au demarrage plutot qu'a chaque appel d'outil si la config est invalide
+    init_vertex()
+
     async with stdio_server() as (read_stream, write_stream):
         await server.run(read_stream, write_stream, server.create_initialization_options())
 